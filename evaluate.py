@@ -5,6 +5,7 @@ import argparse
 import json
 import os
 import shutil
+import zipfile
 
 import torch
 import valohai
@@ -16,6 +17,7 @@ from monai.transforms import (Compose, EnsureChannelFirstd, LoadImaged,
                               ResizeWithPadOrCropd)
 
 from utils.model import get_model_network
+from utils.sliding_window import get_sw_batch_size
 from utils.transforms import get_transforms
 from utils.visualizations import plot_slices_max_label
 
@@ -67,12 +69,12 @@ def evaluate_model(model_path, data_dir, labels_dir, device, batch_size=1):
     model.to(device)
     model.eval()
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for val_data in val_loader:
             val_inputs = val_data["image"].to(device)
             val_labels = val_data["label"].to(device)
             roi_size = (160, 160, 160)
-            sw_batch_size = 4
+            sw_batch_size = get_sw_batch_size(val_inputs.shape[2:], roi_size)
             val_data["pred"] = sliding_window_inference(
                 val_inputs, roi_size, sw_batch_size, model
             )
@@ -126,8 +128,9 @@ if __name__ == "__main__":
     extract_dir = os.path.join(os.path.dirname(preprocessed_data_archive), "extracted_data")
     os.makedirs(extract_dir, exist_ok=True)
 
-    # unzip the preprocessed data
-    shutil.unpack_archive(preprocessed_data_archive, extract_dir, format='zip')
+    # unpack the preprocessed data (tar, or zip from older preprocess runs)
+    archive_format = 'zip' if zipfile.is_zipfile(preprocessed_data_archive) else 'tar'
+    shutil.unpack_archive(preprocessed_data_archive, extract_dir, format=archive_format)
 
     # Set data directories
     data_dir = os.path.join(extract_dir, "imagesTs")
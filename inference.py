@@ -10,9 +10,10 @@ import torch
 import valohai
 from monai.data import DataLoader, Dataset, decollate_batch
 from monai.inferers import sliding_window_inference
-from monai.transforms import AsDiscreted, Compose, Invertd, SaveImaged
+from monai.transforms import Compose, Invertd, SaveImaged
 
 from utils.model import get_model_network
+from utils.sliding_window import get_num_windows, get_sw_batch_size
 from utils.transforms import get_transforms
 from utils.visualizations import visualize_preprocessed_image
 
@@ -22,8 +23,28 @@ def parse_args():
     parser.add_argument('--in_channels', type=int, default=1)
     parser.add_argument('--out_channels', type=int, default=3)
     parser.add_argument('--num_res_units', type=int, default=2)
-    parser.add_argument('--channels', type=lambda s: list(map(int, s.split(','))))
-    return parser.parse_args()
+    # 'extend' accepts both `--channels 16 32` and repeated `--channels=16`
+    parser.add_argument('--channels', type=int, nargs='+', action='extend')
+    args = parser.parse_args()
+    if args.channels is None:
+        args.channels = [16, 32, 64, 128]
+    return args
+
+
+def _argmax_predictor(predictor):
+    """
+    Wrap a predictor to return class ids instead of class logits.
+
+    Args:
+        predictor: Callable mapping window batches to logits
+
+    Returns:
+        Callable mapping window batches to uint8 class ids
+    """
+    def predict(inputs):
+        return predictor(inputs).argmax(dim=1, keepdim=True).to(torch.uint8)
+
+    return predict
 
 
 def run_inference(ckpt, input_image_path, output_path, model):
@@ -36,12 +57,21 @@ def run_inference(ckpt, input_image_path, output_path, model):
         output_path (str): Path to save segmentation mask
     """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    use_amp = device.type == "cuda"
 
     # Initialize model
     model.load_state_dict(torch.load(ckpt, map_location=device))
-    model.to(device)
+    torch.backends.cudnn.benchmark = True
+    model.to(device, memory_format=torch.channels_last_3d)
     model.eval()
 
+    # Trace once so each sliding window skips the eager per-layer dispatch
+    with torch.no_grad():
+        example = torch.zeros(1, model.in_channels, 160, 160, 160, device=device)
+        example = example.to(memory_format=torch.channels_last_3d)
+        # The check would run two extra full-size forwards
+        model = torch.jit.trace(model, example, check_trace=False)
+
     # Define transforms
     inference_transform = get_transforms('inference')
 
@@ -57,7 +87,6 @@ def run_inference(ckpt, input_image_path, output_path, model):
             nearest_interp=True,
             to_tensor=True,
         ),
-        AsDiscreted(keys="pred", argmax=True),
         SaveImaged(
             keys="pred",
             meta_keys="pred_meta_dict",
@@ -76,26 +105,52 @@ def run_inference(ckpt, input_image_path, output_path, model):
     test_loader = DataLoader(test_ds, batch_size=1, num_workers=0)
 
     # Inference loop
-    with torch.no_grad():
+    with torch.inference_mode():
         for batch in test_loader:
-            test_inputs = batch["image"].to(device)
-            test_outputs = sliding_window_inference(
-                test_inputs, (160, 160, 160), 4, model
+            test_inputs = batch["image"].to(
+                device, memory_format=torch.channels_last_3d
             )
-
-            # Prepare for inversion and saving
+            roi_size = (160, 160, 160)
+            num_windows = get_num_windows(
+                test_inputs.shape[2:], roi_size, overlap=0.25
+            )
+            sw_batch_size = get_sw_batch_size(
+                test_inputs.shape[2:], roi_size, overlap=0.25
+            )
+            # Blending class ids is only exact when no windows overlap, so
+            # the argmax is fused into the predictor for single-window
+            # volumes and the aggregation buffer holds 1 channel, not C
+            fuse_argmax = num_windows == 1
+            # Windows run in FP16 on the GPU and the aggregated output is
+            # kept on the CPU. The inference transforms resize inputs to
+            # a single 160^3 window, so the gaussian blending and the
+            # buffer_steps/buffer_dim Z-slab buffering only take effect
+            # if larger inputs are ever passed in
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                predictor = _argmax_predictor(model) if fuse_argmax else model
+                test_outputs = sliding_window_inference(
+                    test_inputs,
+                    roi_size,
+                    sw_batch_size=sw_batch_size,
+                    predictor=predictor,
+                    overlap=0.25,
+                    mode="constant" if fuse_argmax else "gaussian",
+                    sw_device=device,
+                    device="cpu",
+                    buffer_steps=1,
+                    buffer_dim=-1,
+                )
+            if not fuse_argmax:
+                test_outputs = test_outputs.argmax(dim=1, keepdim=True)
+
+            # Decollate the whole batch so each sample carries its own meta
+            batch_data = decollate_batch(batch)
             decollated_outputs = decollate_batch(test_outputs)
-            batch_data = []
-            for i, pred in enumerate(decollated_outputs):
-                batch_data.append({
-                    "pred": pred,
-                    "image": batch["image"][i],
-                    "pred_meta_dict": batch["image_meta_dict"],
-                    "image_meta_dict": batch["image_meta_dict"]
-                })
 
             # Apply post transforms (inversion + save)
-            for data_dict in batch_data:
+            for data_dict, pred in zip(batch_data, decollated_outputs):
+                data_dict["pred"] = pred
+                data_dict["pred_meta_dict"] = data_dict["image_meta_dict"]
                 post_transforms(data_dict)
 
             # Strip extension and add _pred.nii.gz
@@ -107,9 +162,12 @@ def run_inference(ckpt, input_image_path, output_path, model):
 
             pred_path = os.path.join(output_path, pred_name)
 
+            # The mask is needed whole to pick the slice, the image is
+            # passed as its array proxy so only that slice is materialised
+            # (the gzip stream is still mostly decompressed to reach it)
             visualize_preprocessed_image(
-                nib.load(input_image_path).get_fdata(),
-                nib.load(pred_path).get_fdata().astype(np.uint8),
+                nib.load(input_image_path).dataobj,
+                np.asarray(nib.load(pred_path).dataobj, dtype=np.uint8),
                 valohai.outputs("my-output").path("sample_inference.png")
             )
 
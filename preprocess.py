@@ -5,6 +5,7 @@ import json
 import os
 import shutil
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from glob import glob
 from typing import Dict, List
 
@@ -23,6 +24,35 @@ from utils.visualizations import visualize_preprocessed_image
 FILE_KEYS = ["image", "label"]
 
 
+def _save_pair(
+    image: np.ndarray,
+    image_affine: np.ndarray,
+    label: np.ndarray,
+    label_affine: np.ndarray,
+    image_path: str,
+    label_path: str
+) -> None:
+    """
+    Save a processed image and label pair as NIfTI files.
+
+    Args:
+        image: Image volume
+        image_affine: Affine of the image volume
+        label: Label volume
+        label_affine: Affine of the label volume
+        image_path: Output path for the image
+        label_path: Output path for the label
+    """
+    # Pin the on-disk dtypes so the header never widens the data
+    image_nifti = nib.Nifti1Image(image, image_affine)
+    image_nifti.set_data_dtype(np.float32)
+    nib.save(image_nifti, image_path)
+
+    label_nifti = nib.Nifti1Image(label, label_affine)
+    label_nifti.set_data_dtype(np.int16)
+    nib.save(label_nifti, label_path)
+
+
 def process_dataset(
     data_dicts: List[Dict[str, str]],
     dataset_transform: Transform,
@@ -45,24 +75,44 @@ def process_dataset(
     os.makedirs(images_dir, exist_ok=True)
     os.makedirs(labels_dir, exist_ok=True)    
     print(f"Processing {len(dataset)} samples for {output_subdir}...")
-    for i, sample in enumerate(tqdm(dataset, desc=f"Processing {output_subdir}", unit="sample")):
-        base_name = os.path.splitext(os.path.basename(data_dicts[i]["image"]))[0]
-
-        image = sample["image"].detach().cpu().numpy().squeeze()
-        label = sample["label"].detach().cpu().numpy().squeeze().astype(np.int16)
-
-        # Use affine from MONAI transform metadata
-        image_affine = sample["image_meta_dict"]["affine"]
-        label_affine = sample["label_meta_dict"]["affine"]
-
-        # Save the processed files
-        nib.save(nib.Nifti1Image(image, image_affine), os.path.join(images_dir, f"{base_name}.gz"))
-        nib.save(nib.Nifti1Image(label, label_affine), os.path.join(labels_dir, f"{base_name}.gz"))
-
-        output_path = valohai.outputs("my-output").path(f"sample_{i}.png")
-
-        if i < 5:  # Visualize only the first 5 samples
-            visualize_preprocessed_image(image, label, output_path)
+    # gzip compression is single-threaded per file, so saves run in a pool
+    max_workers = max(1, (os.cpu_count() or 2) // 2)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for i, sample in enumerate(tqdm(dataset, desc=f"Processing {output_subdir}", unit="sample")):
+            base_name = os.path.splitext(os.path.basename(data_dicts[i]["image"]))[0]
+
+            image = sample["image"].detach().cpu().numpy().squeeze().astype(np.float32, copy=False)
+            label = sample["label"].detach().cpu().numpy().squeeze().astype(np.int16)
+
+            # Use affine from MONAI transform metadata
+            image_affine = np.asarray(sample["image_meta_dict"]["affine"])
+            label_affine = np.asarray(sample["label_meta_dict"]["affine"])
+
+            # Bound the queue so unsaved volumes don't pile up in memory
+            if len(pending) >= 2 * max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            # Save the processed files
+            pending.add(executor.submit(
+                _save_pair,
+                image,
+                image_affine,
+                label,
+                label_affine,
+                os.path.join(images_dir, f"{base_name}.gz"),
+                os.path.join(labels_dir, f"{base_name}.gz")
+            ))
+
+            output_path = valohai.outputs("my-output").path(f"sample_{i}.png")
+
+            if i < 5:  # Visualize only the first 5 samples
+                visualize_preprocessed_image(image, label, output_path)
+
+        for future in pending:
+            future.result()
 
     print(f"Saved {len(dataset)} samples to {images_dir} and {labels_dir}")
 
@@ -113,15 +163,16 @@ def preprocess_train_val(data_dir: str, labels_tr: str, output_dir: str) -> None
         output_dir=output_dir
     )
 
-    # Get zip output path
-    zip_output_path = valohai.outputs().path("preprocessed")
+    # Get archive output path
+    archive_output_path = valohai.outputs().path("preprocessed")
 
-    # Zip the entire processed output folder
-    shutil.make_archive(zip_output_path, 'zip', output_dir)
+    # Archive the processed output folder without compression, the
+    # .nii.gz payload is already compressed
+    shutil.make_archive(archive_output_path, 'tar', output_dir)
 
     # Save Valohai metadata
     metadata = {
-        "preprocessed.zip": {
+        "preprocessed.tar": {
             "valohai.dataset-versions": [
                  "dataset://task03_liver/version1"
              ],
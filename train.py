@@ -5,21 +5,25 @@ import argparse
 import json
 import os
 import shutil
+import tarfile
+import zipfile
 from typing import Tuple
 
 import torch
 import valohai
-from monai.data import DataLoader, Dataset, decollate_batch
+from monai.data import (CacheDataset, DataLoader, decollate_batch,
+                        list_data_collate)
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceLoss
 from monai.metrics import DiceMetric, MeanIoU
-from monai.transforms import (Compose, EnsureChannelFirstd, LoadImaged,
-                              RandCropByPosNegLabeld, RandFlipd,
-                              RandGaussianNoised, RandRotate90d)
+from monai.networks.utils import one_hot
+from monai.transforms import (Compose, EnsureChannelFirstd, Lambdad,
+                              LoadImaged, RandCropByPosNegLabeld, RandFlipd,
+                              RandRotate90d, ToDeviced)
 from sklearn.model_selection import train_test_split
 
 from utils.model import get_model_network
-from utils.transforms import get_transforms
+from utils.sliding_window import get_sw_batch_size
 from utils.visualizations import plot_slices_max_label
 
 
@@ -38,11 +42,67 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--in_channels', type=int, default=1)
     parser.add_argument('--out_channels', type=int, default=3)
     parser.add_argument('--num_res_units', type=int, default=2)
-    parser.add_argument(
-        '--channels',
-        type=lambda s: list(map(int, s.split(',')))
-    )
-    return parser.parse_args()
+    # 'extend' accepts both `--channels 16 32` and repeated `--channels=16`
+    parser.add_argument('--channels', type=int, nargs='+', action='extend')
+    parser.add_argument('--amp', type=int, default=1)
+    args = parser.parse_args()
+    if args.channels is None:
+        args.channels = [16, 32, 64, 128]
+    return args
+
+
+def add_gaussian_noise(
+    image: torch.Tensor,
+    prob: float = 0.5,
+    std: float = 0.1
+) -> torch.Tensor:
+    """
+    Add zero-mean gaussian noise to an image with the given probability.
+
+    Mirrors RandGaussianNoise (std sampled from [0, std)), but draws the
+    noise with torch on the image's device instead of NumPy on the CPU.
+
+    Args:
+        image: Image tensor
+        prob: Probability of adding noise
+        std: Upper bound of the noise standard deviation
+
+    Returns:
+        Image with or without noise
+    """
+    if torch.rand(()) >= prob:
+        return image
+    return image + torch.randn_like(image) * (torch.rand(()).item() * std)
+
+
+def get_train_augmentations(device: torch.device) -> Compose:
+    """
+    Get random training augmentations, applied per sample on the device.
+
+    Args:
+        device: Device to move the samples to before augmenting
+
+    Returns:
+        Composed random transforms
+    """
+    return Compose([
+        ToDeviced(keys=["image", "label"], device=device, non_blocking=True),
+        RandCropByPosNegLabeld(
+            keys=["image", "label"],
+            label_key="label",
+            spatial_size=(160, 160, 160),
+            pos=1,
+            neg=1,
+            num_samples=4,
+            image_key="image",
+            image_threshold=0,
+            allow_smaller=True
+        ),
+        RandRotate90d(keys=["image", "label"], prob=0.5),
+        RandFlipd(keys=["image", "label"], prob=0.5, spatial_axis=[0]),
+        # Drawn per crop, like RandGaussianNoised was
+        Lambdad(keys=["image"], func=add_gaussian_noise),
+    ])
 
 
 def train_model(
@@ -51,7 +111,8 @@ def train_model(
     model: torch.nn.Module,
     num_epochs: int = 100,
     learning_rate: float = 1e-4,
-    ckpt_path: str = "checkpoints"
+    ckpt_path: str = "checkpoints",
+    use_amp: bool = True
 ) -> torch.nn.Module:
     """
     Train liver segmentation model.
@@ -63,6 +124,7 @@ def train_model(
         num_epochs: Number of training epochs
         learning_rate: Learning rate for optimization
         ckpt_path: Path to save checkpoints
+        use_amp: Whether to use FP16 mixed precision on CUDA
 
     Returns:
         Trained model
@@ -73,12 +135,18 @@ def train_model(
 
     os.makedirs(ckpt_path, exist_ok=True)
 
-    model = model.to(device)
+    # Input shapes are fixed, let cuDNN pick the fastest 3D conv kernels
+    torch.backends.cudnn.benchmark = True
+    model = model.to(device, memory_format=torch.channels_last_3d)
 
     # Loss function and optimizer
     loss_function = DiceLoss(to_onehot_y=True, softmax=True)
     optimizer = torch.optim.Adam(model.parameters(), learning_rate)
 
+    # Mixed precision (no-op on CPU)
+    use_amp = use_amp and device.type == "cuda"
+    scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
+
     # Metric
     dice_metric = DiceMetric(include_background=False, reduction="mean")
     mean_iou_metric = MeanIoU(include_background=False, reduction="mean")
@@ -89,33 +157,43 @@ def train_model(
     epoch_loss_values = []
     dice_values = []
 
-    post_transforms = get_transforms('post_transforms')
+    train_augmentations = get_train_augmentations(device)
 
     for epoch in range(num_epochs):
         model.train()
-        epoch_loss = 0
+        # Accumulate on the device, syncing only for the periodic log
+        loss_accum = torch.zeros((), device=device)
         step = 0
 
         for batch_data in train_loader:
             step += 1
-            inputs = batch_data["image"].to(device)
-            labels = batch_data["label"].to(device)
-
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = loss_function(outputs, labels)
-            loss.backward()
-            optimizer.step()
-
-            epoch_loss += loss.item()
-            print(
-                f"{step}/{len(train_loader)}, "
-                f"train_loss: {loss.item():.4f}, "
-                f"val_loss: {epoch_loss / step:.4f}",
-                end='\r'
+            # Random augmentations run on the device, not in the workers
+            batch_data = list_data_collate([
+                train_augmentations(d) for d in decollate_batch(batch_data)
+            ])
+            inputs = batch_data["image"].to(
+                device, memory_format=torch.channels_last_3d, non_blocking=True
             )
-
-        epoch_loss /= step
+            labels = batch_data["label"].to(device, non_blocking=True)
+
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                outputs = model(inputs)
+                loss = loss_function(outputs, labels)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            loss_accum += loss.detach()
+            if step % 20 == 0:
+                print(
+                    f"{step}/{len(train_loader)}, "
+                    f"train_loss: {loss.item():.4f}, "
+                    f"val_loss: {loss_accum.item() / step:.4f}",
+                    end='\r'
+                )
+
+        epoch_loss = (loss_accum / step).item()
         epoch_loss_values.append(epoch_loss)
 
         print(f"epoch {epoch + 1} average loss: {epoch_loss:.4f}")
@@ -128,33 +206,28 @@ def train_model(
         # Validation
         if (epoch + 1) % 5 == 0:
             model.eval()
-            with torch.no_grad():
+            with torch.inference_mode():
                 for val_data in val_loader:
-                    val_inputs = val_data["image"].to(device)
-                    val_labels = val_data["label"].to(device)
+                    val_inputs = val_data["image"].to(
+                        device, memory_format=torch.channels_last_3d, non_blocking=True
+                    )
+                    val_labels = val_data["label"].to(device, non_blocking=True)
 
                     # Sliding window inference for large images
                     roi_size = (160, 160, 160)
-                    sw_batch_size = 4
-                    val_outputs = sliding_window_inference(
-                        val_inputs, roi_size, sw_batch_size, model
-                    )
-
-                    # Create batch dictionary and apply post transforms
-                    val_batch_data = [
-                        {"pred": pred, "label": label}
-                        for pred, label in zip(
-                            decollate_batch(val_outputs),
-                            decollate_batch(val_labels)
+                    sw_batch_size = get_sw_batch_size(val_inputs.shape[2:], roi_size)
+                    with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                        val_outputs = sliding_window_inference(
+                            val_inputs, roi_size, sw_batch_size, model
                         )
-                    ]
-
-                    # Apply post-transforms to the batch data
-                    val_batch_data = [post_transforms(d) for d in val_batch_data]
 
-                    # Extract processed predictions and labels
-                    val_outputs = [d["pred"] for d in val_batch_data]
-                    val_labels = [d["label"] for d in val_batch_data]
+                    # Post transforms are deterministic, so apply the
+                    # argmax + one-hot on the whole batch on the device
+                    num_classes = val_outputs.shape[1]
+                    val_outputs = one_hot(
+                        val_outputs.argmax(dim=1, keepdim=True), num_classes, dim=1
+                    )
+                    val_labels = one_hot(val_labels, num_classes, dim=1)
 
                     plot_slices_max_label(
                         val_inputs[0],
@@ -243,24 +316,11 @@ def get_data_loaders(
         random_state=42
     )
 
-    # Define Random transforms
+    # Workers only load, random augmentations run on the device in
+    # train_model. CacheDataset keeps the loaded volumes in memory.
     train_transforms = Compose([
         LoadImaged(keys=["image", "label"]),
         EnsureChannelFirstd(keys=["image", "label"]),
-        RandCropByPosNegLabeld(
-            keys=["image", "label"],
-            label_key="label",
-            spatial_size=(160, 160, 160),
-            pos=1,
-            neg=1,
-            num_samples=4,
-            image_key="image",
-            image_threshold=0,
-            allow_smaller=True
-        ),
-        RandRotate90d(keys=["image", "label"], prob=0.5),
-        RandFlipd(keys=["image", "label"], prob=0.5, spatial_axis=[0]),
-        RandGaussianNoised(keys=["image"], prob=0.5)
     ])
 
     val_transforms = Compose([
@@ -269,17 +329,31 @@ def get_data_loaders(
     ])
 
     train_loader = DataLoader(
-        Dataset(data=train_data, transform=train_transforms),
+        CacheDataset(
+            data=train_data,
+            transform=train_transforms,
+            cache_rate=1.0,
+            num_workers=4
+        ),
         batch_size=batch_size,
         shuffle=True,
-        num_workers=4,
+        num_workers=2,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=True,
+        prefetch_factor=4,
     )
 
     val_loader = DataLoader(
-        Dataset(data=val_data, transform=val_transforms),
+        CacheDataset(
+            data=val_data,
+            transform=val_transforms,
+            cache_rate=1.0,
+            num_workers=4
+        ),
         batch_size=batch_size,
         shuffle=False,
         num_workers=4,
+        pin_memory=torch.cuda.is_available(),
     )
 
     return train_loader, val_loader
@@ -288,6 +362,12 @@ def get_data_loaders(
 if __name__ == "__main__":
     args = parse_args()
 
+    if any(c % 8 for c in args.channels):
+        print(
+            f"Warning: channels {args.channels} are not all divisible by 8, "
+            "FP16 tensor-core conv kernels will not be used"
+        )
+
     preprocessed_data_archive = valohai.inputs('preprocessed_data').path(
         process_archives=False
     )
@@ -299,8 +379,16 @@ if __name__ == "__main__":
     )
     os.makedirs(extract_dir, exist_ok=True)
 
-    # unzip the preprocessed data
-    shutil.unpack_archive(preprocessed_data_archive, extract_dir, format='zip')
+    if zipfile.is_zipfile(preprocessed_data_archive):
+        # Archives from older preprocess runs are zip
+        shutil.unpack_archive(preprocessed_data_archive, extract_dir, format='zip')
+    else:
+        # Stream the uncompressed tar in a single sequential pass, writing
+        # only the training split (the test split is for evaluation)
+        with tarfile.open(preprocessed_data_archive, 'r|') as archive:
+            for member in archive:
+                if member.name.lstrip('./').startswith(("imagesTr", "labelsTr")):
+                    archive.extract(member, extract_dir, filter='data')
 
     # Set data directories
     data_dir = os.path.join(extract_dir, "imagesTr")
@@ -328,5 +416,6 @@ if __name__ == "__main__":
         model=model,
         num_epochs=args.epochs,
         learning_rate=args.lr,
-        ckpt_path=args.ckpt
+        ckpt_path=args.ckpt,
+        use_amp=bool(args.amp)
     )
\ No newline at end of file
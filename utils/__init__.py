@@ -1,14 +1,17 @@
 """
 Utils package for MONAI medical imaging project.
-Contains model, transforms, and visualization utilities.
+Contains model, sliding window, transforms, and visualization utilities.
 """
 
 from .model import get_model_network
+from .sliding_window import get_num_windows, get_sw_batch_size
 from .transforms import get_transforms
 from .visualizations import plot_slices_max_label, visualize_preprocessed_image
 
 __all__ = [
     'get_model_network',
+    'get_num_windows',
+    'get_sw_batch_size',
     'get_transforms',
     'visualize_preprocessed_image',
     'plot_slices_max_label'
@@ -0,0 +1,50 @@
+import math
+from typing import Sequence
+
+
+def get_num_windows(
+    image_size: Sequence[int],
+    roi_size: Sequence[int],
+    overlap: float = 0.25
+) -> int:
+    """
+    Get the number of windows sliding_window_inference scans a volume with.
+
+    Args:
+        image_size: Spatial size of the input volume
+        roi_size: Spatial size of each window
+        overlap: Overlap ratio between neighbouring windows
+
+    Returns:
+        Total number of windows
+    """
+    num_windows = 1
+    for size, roi in zip(image_size, roi_size):
+        if size <= roi:
+            continue
+        interval = max(int(roi * (1 - overlap)), 1)
+        num_windows *= math.ceil((size - roi) / interval) + 1
+
+    return num_windows
+
+
+def get_sw_batch_size(
+    image_size: Sequence[int],
+    roi_size: Sequence[int],
+    overlap: float = 0.25,
+    max_batch_size: int = 4
+) -> int:
+    """
+    Get the sliding window batch size clamped to the number of windows.
+
+    Args:
+        image_size: Spatial size of the input volume
+        roi_size: Spatial size of each window
+        overlap: Overlap ratio between neighbouring windows
+        max_batch_size: Upper bound on the batch size
+
+    Returns:
+        Number of windows to run per forward pass
+    """
+    return min(max_batch_size, get_num_windows(image_size, roi_size, overlap))
+
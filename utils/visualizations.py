@@ -4,10 +4,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import valohai
+from nibabel.arrayproxy import ArrayProxy
 
 
 def visualize_preprocessed_image(
-    image: np.ndarray,
+    image: Union[np.ndarray, ArrayProxy],
     label: np.ndarray,
     output_path
 ) -> None:
@@ -15,16 +16,18 @@ def visualize_preprocessed_image(
     Visualize preprocessed image and label.
 
     Args:
-        image: Input image array
+        image: Input image array, or a nibabel array proxy so only the
+            plotted slice is kept in memory
         label: Label array
         output_path: Path to save the visualization
     """
-    image_np = image.squeeze()  # Shape: (Z, Y, X)
+    if isinstance(image, np.ndarray):
+        image = image.squeeze()  # Shape: (Z, Y, X)
     label_np = label.squeeze()
     # Coronal: find the Y-slice with the most label voxels
-    slice_index = np.argmax(np.sum(label_np, axis=(0, 2)))  # axis=1 is Y
+    slice_index = int(np.argmax(np.sum(label_np, axis=(0, 2))))  # axis=1 is Y
     # Extract the coronal slice (Z, X)
-    image_slice = image_np[:, slice_index, :]
+    image_slice = np.asarray(image[:, slice_index, :], dtype=np.float32)
     label_slice = label_np[:, slice_index, :]
     plt.figure(figsize=(24, 12))
     plt.subplot(1, 2, 1)